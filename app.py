@@ -1,27 +1,48 @@
-import uuid
+import hashlib
+import os
+import re
+import secrets
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Iterator
 from pathlib import Path
+from types import MappingProxyType
 
+import orjson
 import requests as http
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, stream_with_context
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BASE_DIR = Path(__file__).resolve().parent
 MAX_MESSAGES = 15
+MAX_SESSIONS = 10_000
+REPLY_CACHE_SIZE = 1024
+
+# Upstream HTTP: pool sizes, retry policy and (connect, read) timeouts.
+# POOL_MAXSIZE is how many keep-alive connections are kept per host; bursts
+# beyond it open extra connections that are closed after use. The pool is
+# deliberately non-blocking: requests never passes a pool timeout, so a
+# blocking pool would queue requests with no deadline.
+POOL_CONNECTIONS = 20
+POOL_MAXSIZE = 100
+UPSTREAM_RETRIES = 2
+UPSTREAM_TIMEOUT = (5, 120)
+ERROR_DETAIL_BYTES = 512
 
 # ---------------------------------------------------------------------------
 # Startup: load config + prompts
 # ---------------------------------------------------------------------------
 
+# KEY=value lines; blank lines and "#" comments never match the key pattern.
+_CONFIG_RE = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t\r]*$", re.M)
+
+
 def load_config():
     path = BASE_DIR / "config.txt"
     if not path.exists():
         raise SystemExit(f"Missing config file: {path}")
-    cfg = {}
-    for line in path.read_text().splitlines():
-        line = line.strip()
-        if not line or line.startswith("#"):
-            continue
-        key, _, value = line.partition("=")
-        cfg[key.strip()] = value.strip()
+    cfg = {m.group(1): m.group(2) for m in _CONFIG_RE.finditer(path.read_text())}
     for required in ("PROVIDER", "MODEL"):
         if required not in cfg:
             raise SystemExit(f"Missing '{required}' in config.txt")
@@ -45,46 +66,63 @@ def load_text_file(name):
     return path.read_text(encoding="utf-8-sig").strip()
 
 
+def _faq_block(row: str) -> str | None:
+    """Format one merged TSV row as a Q/A block (None if it has no content)."""
+    main_q, syn2, syn3, answer = (c.strip() for c in row.split("\t", 3))
+    answer = answer.strip('"')
+    if not main_q and not answer:
+        return None
+    parts = [f"Q: {main_q}"] if main_q else [""]
+    synonyms = [s for s in (syn2, syn3) if s]
+    if synonyms:
+        parts.append(f"(также: {'; '.join(synonyms)})")
+    parts.append(f"A: {answer}")
+    return "\n".join(parts)
+
+
 def parse_faq_tsv(raw: str) -> str:
     """Parse tab-separated FAQ into structured Q/A blocks.
 
     Handles multi-line quoted answers by joining continuation lines
     (lines with fewer than 3 tab characters) back onto the previous row.
+    Rows are collected as line lists and joined once, in a single pass.
     """
-    raw_lines = raw.splitlines()
-    if not raw_lines:
-        return raw
-
-    # --- pass 1: merge continuation lines into full rows ---------------
-    rows: list[str] = []
-    for line in raw_lines[1:]:            # skip header
-        if line.count("\t") >= 3:
-            rows.append(line)             # new row
-        elif rows:
-            rows[-1] += "\n" + line       # continuation of previous answer
-
-    # --- pass 2: parse each row into a Q/A block ----------------------
-    entries = []
-    for row in rows:
-        cols = row.split("\t", 3)         # split into exactly 4 parts
-        if len(cols) < 4:
-            continue
-        main_q = cols[0].strip()
-        syn2 = cols[1].strip()
-        syn3 = cols[2].strip()
-        answer = cols[3].strip().strip('"')
-        if not main_q and not answer:
-            continue
-        block = f"Q: {main_q}" if main_q else ""
-        synonyms = [s for s in (syn2, syn3) if s]
-        if synonyms:
-            block += f"\n(также: {'; '.join(synonyms)})"
-        block += f"\nA: {answer}"
+    entries: list[str] = []
+    current: list[str] = []               # lines of the row being built
+    lines = iter(raw.splitlines())
+    next(lines, None)                     # skip header
+    for line in lines:
+        if line.count("\t") >= 3:         # new row: flush the previous one
+            if current and (block := _faq_block("\n".join(current))):
+                entries.append(block)
+            current = [line]
+        elif current:
+            current.append(line)          # continuation of previous answer
+    if current and (block := _faq_block("\n".join(current))):
         entries.append(block)
     return "\n\n".join(entries)
 
 
 config = load_config()
+PROVIDER = config["PROVIDER"]
+MODEL = config["MODEL"]
+
+if PROVIDER == "glm":
+    API_URL = config["GLM_BASE_URL"].rstrip("/") + "/chat/completions"
+    API_KEY = config["GLM_API_KEY"]
+else:
+    API_URL = "https://openrouter.ai/api/v1/chat/completions"
+    API_KEY = config["OPENROUTER_API_KEY"]
+
+# Read-only view: the same dict is handed to every request (requests copies
+# it when merging with the session headers), so it must never be mutated.
+AUTH_HEADERS = MappingProxyType({
+    "Authorization": f"Bearer {API_KEY}",
+    "Content-Type": "application/json",
+})
+
+REPLY_CACHE_ENABLED = config.get("ENABLE_REPLY_CACHE", "0").lower() in ("1", "true", "yes")
+
 system_prompt_text = load_text_file("system_prompt.txt")
 faq_text = parse_faq_tsv(load_text_file("faq.txt"))
 
@@ -93,56 +131,233 @@ SYSTEM_MESSAGE = {
     "content": f"{system_prompt_text}\n\n{faq_text}",
 }
 
+# Everything in the request body up to and including the system message is
+# static (and the system message dominates its size), so that prefix is
+# encoded once here; per request only the history is encoded and appended.
+REQUEST_PREFIX = (
+    b'{"model":' + orjson.dumps(MODEL)
+    + b',"temperature":0.3,"messages":[' + orjson.dumps(SYSTEM_MESSAGE)
+)
+STREAM_REQUEST_PREFIX = b'{"stream":true,' + REQUEST_PREFIX[1:]
+
 # ---------------------------------------------------------------------------
 # Session store (in-memory)
 # ---------------------------------------------------------------------------
 
-sessions: dict[str, list[dict]] = {}
+# LRU-ordered: the least recently used session sits at the front and is
+# evicted once MAX_SESSIONS is reached. Structural changes (lookup, insert,
+# evict) take _sessions_lock; history contents use the striped locks below.
+sessions: OrderedDict[str, deque[dict]] = OrderedDict()
+_sessions_lock = threading.Lock()
+
+# Striped locks: per-session history mutations serialize on one of N locks
+# so disjoint sessions rarely contend and no single global lock is needed.
+SESSION_LOCK_STRIPES = 64
+_session_locks = [threading.Lock() for _ in range(SESSION_LOCK_STRIPES)]
+
+
+def _lock_for(session_id: str) -> threading.Lock:
+    return _session_locks[hash(session_id) % SESSION_LOCK_STRIPES]
 
 
-def get_or_create_session(session_id: str | None) -> tuple[str, list[dict]]:
-    if session_id and session_id in sessions:
-        return session_id, sessions[session_id]
-    new_id = str(uuid.uuid4())
-    sessions[new_id] = []
-    return new_id, sessions[new_id]
+def get_or_create_session(session_id: str | None) -> tuple[str, deque[dict]]:
+    with _sessions_lock:
+        if session_id and session_id in sessions:
+            sessions.move_to_end(session_id)
+            return session_id, sessions[session_id]
+        new_id = secrets.token_urlsafe(16)
+        if len(sessions) >= MAX_SESSIONS:
+            sessions.popitem(last=False)
+        history = sessions[new_id] = deque(maxlen=MAX_MESSAGES)
+    return new_id, history
 
 # ---------------------------------------------------------------------------
 # LLM call (GLM or OpenRouter)
 # ---------------------------------------------------------------------------
 
-def _api_url() -> str:
-    if config["PROVIDER"] == "glm":
-        return config["GLM_BASE_URL"].rstrip("/") + "/chat/completions"
-    return "https://openrouter.ai/api/v1/chat/completions"
+def build_http_session() -> http.Session:
+    """Shared keep-alive session so TLS handshakes are paid once per pooled
+    connection instead of once per /ask."""
+    session = http.Session()
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        # POST is not in urllib3's retryable methods, so only connection
+        # failures are retried; a sent completion is never replayed.
+        max_retries=Retry(total=UPSTREAM_RETRIES, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+
+SESSION = build_http_session()
+
+
+# Optional LRU of final replies keyed by a digest of the encoded history, so
+# identical conversations replay without an upstream round-trip. Model and
+# system prompt are fixed for the process's lifetime, so they need not be
+# hashed. Enabled with ENABLE_REPLY_CACHE=1.
+_reply_cache: OrderedDict[bytes, str] = OrderedDict()
+_reply_cache_lock = threading.Lock()
+
+
+def _reply_cache_key(body: bytes, stream: bool = False) -> bytes | None:
+    """Digest the history suffix of a request body built by build_request_body.
+
+    Skipping the (endpoint-specific) prefix lets buffered and streamed
+    requests for the same history share one cache entry.
+    """
+    if not REPLY_CACHE_ENABLED:
+        return None
+    prefix_len = len(STREAM_REQUEST_PREFIX if stream else REQUEST_PREFIX)
+    return hashlib.blake2b(memoryview(body)[prefix_len:], digest_size=16).digest()
+
+
+def _cached_reply(key: bytes | None) -> str | None:
+    if key is None:
+        return None
+    with _reply_cache_lock:
+        reply = _reply_cache.get(key)
+        if reply is not None:
+            _reply_cache.move_to_end(key)
+        return reply
+
+
+def _store_reply(key: bytes | None, reply: str) -> None:
+    if key is None:
+        return
+    with _reply_cache_lock:
+        _reply_cache[key] = reply
+        _reply_cache.move_to_end(key)
+        if len(_reply_cache) > REPLY_CACHE_SIZE:
+            _reply_cache.popitem(last=False)
+
+
+def _raise_for_status(resp: http.Response) -> None:
+    """Raise RuntimeError for a non-2xx reply, reading at most ERROR_DETAIL_BYTES.
+
+    Responses are requested with stream=True, so an oversized error page is
+    never downloaded or charset-sniffed in full.
+    """
+    if 200 <= resp.status_code < 300:
+        return
+    with resp:
+        detail = resp.raw.read(ERROR_DETAIL_BYTES, decode_content=True)
+    raise RuntimeError(f"API {resp.status_code}: {detail.decode('utf-8', 'replace')}")
+
 
+EMPTY_REPLY_ERROR = "Model returned empty content (reasoning may have exhausted token budget)"
 
-def _api_key() -> str:
-    if config["PROVIDER"] == "glm":
-        return config["GLM_API_KEY"]
-    return config["OPENROUTER_API_KEY"]
+
+def build_request_body(history: list[dict], stream: bool = False) -> bytes:
+    """Encode the completion payload by appending the history to the static prefix."""
+    prefix = STREAM_REQUEST_PREFIX if stream else REQUEST_PREFIX
+    if not history:
+        return prefix + b"]}"
+    return prefix + b"," + orjson.dumps(history)[1:-1] + b"]}"
 
 
 def chat_completion(history: list[dict]) -> str:
-    messages = [SYSTEM_MESSAGE] + history
-    resp = http.post(
-        _api_url(),
-        headers={
-            "Authorization": f"Bearer {_api_key()}",
-            "Content-Type": "application/json",
-        },
-        json={"model": config["MODEL"], "messages": messages, "temperature": 0.3},
-        timeout=120,
-    )
-    if resp.status_code != 200:
-        detail = resp.text[:500]
-        raise RuntimeError(f"API {resp.status_code}: {detail}")
-    data = resp.json()
+    body = build_request_body(history)
+    cache_key = _reply_cache_key(body)
+    if (cached := _cached_reply(cache_key)) is not None:
+        return cached
+
+    # Parse the raw bytes: JSON is UTF-8, so requests' charset detection
+    # (resp.json() / resp.text) is skipped. The with-block hands the
+    # connection back to the pool as soon as the body is read.
+    with SESSION.post(
+        API_URL,
+        headers=AUTH_HEADERS,
+        data=body,
+        timeout=UPSTREAM_TIMEOUT,
+        stream=True,
+    ) as resp:
+        _raise_for_status(resp)
+        try:
+            data = orjson.loads(resp.content)
+        except orjson.JSONDecodeError as exc:
+            raise RuntimeError(f"API returned invalid JSON: {exc}") from exc
     content = data["choices"][0]["message"].get("content", "")
     if not content:
-        raise RuntimeError("Model returned empty content (reasoning may have exhausted token budget)")
+        raise RuntimeError(EMPTY_REPLY_ERROR)
+    _store_reply(cache_key, content)
     return content
 
+
+def chat_completion_stream(history: list[dict]) -> tuple[Iterator[str | None], bytes | None]:
+    """Start a streamed (SSE) completion.
+
+    Returns an iterator of content deltas, followed by None once the reply
+    is complete, plus the reply cache key under which the caller stores the
+    assembled reply. After the None, pass the iterator to drain_stream() so
+    the connection is returned to the pool. The request is sent and its
+    status checked before returning, so an upstream error raises here
+    rather than partway through the stream. A cached reply is returned as
+    a single delta.
+    """
+    body = build_request_body(history, stream=True)
+    cache_key = _reply_cache_key(body, stream=True)
+    if (cached := _cached_reply(cache_key)) is not None:
+        return iter((cached, None)), None
+
+    resp = SESSION.post(
+        API_URL,
+        headers=AUTH_HEADERS,
+        data=body,
+        timeout=UPSTREAM_TIMEOUT,
+        stream=True,
+    )
+    _raise_for_status(resp)
+    return _iter_stream_deltas(resp), cache_key
+
+
+def _iter_stream_deltas(resp: http.Response) -> Iterator[str | None]:
+    complete = False
+    with resp:
+        # Once complete, keep reading until EOF: a fully consumed body lets
+        # close() return the connection to the pool instead of dropping it.
+        for line in resp.iter_lines():
+            if complete or not line.startswith(b"data:"):
+                continue                  # blank separators, ": keep-alive" comments
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                complete = True
+                yield None
+                continue
+            try:
+                chunk = orjson.loads(payload)
+            except orjson.JSONDecodeError as exc:
+                raise RuntimeError(f"API returned invalid stream chunk: {exc}") from exc
+            if not isinstance(chunk, dict):
+                raise RuntimeError(f"API returned invalid stream chunk: {payload[:100]!r}")
+            if "error" in chunk:
+                raise RuntimeError(f"API error: {chunk['error']}")
+            choices = chunk.get("choices")
+            if not choices:
+                continue
+            piece = (choices[0].get("delta") or {}).get("content")
+            if piece:
+                yield piece
+            if choices[0].get("finish_reason"):
+                complete = True
+                yield None
+    # EOF without [DONE] or a finish_reason means the reply was cut off
+    # (provider or proxy closed early): never record or cache it.
+    if not complete:
+        raise RuntimeError("API stream ended before the reply was complete")
+
+
+def drain_stream(deltas: Iterator[str | None]) -> None:
+    """Read a completed stream to EOF so its connection goes back to the pool."""
+    try:
+        for _ in deltas:
+            pass
+    except (RuntimeError, http.RequestException):
+        pass
+
 # ---------------------------------------------------------------------------
 # Flask app
 # ---------------------------------------------------------------------------
@@ -150,52 +365,133 @@ def chat_completion(history: list[dict]) -> str:
 app = Flask(__name__)
 
 
+def json_response(obj, status: int = 200) -> Response:
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+
+def sse_event(obj, event: str | None = None) -> bytes:
+    data = b"data: " + orjson.dumps(obj) + b"\n\n"
+    return f"event: {event}\n".encode() + data if event else data
+
+
+def _read_message() -> str:
+    """Return the stripped "message" field of the JSON body, or "" if absent/invalid."""
+    try:
+        body = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return ""
+    message = body.get("message") if isinstance(body, dict) else None
+    return message.strip() if isinstance(message, str) else ""
+
+
+def _begin_turn(sid: str, history: deque[dict], message: str) -> list[dict]:
+    """Record the user message and return a snapshot of the history to send."""
+    # The deque evicts the oldest message once full; drop an orphaned
+    # assistant reply so the context always opens on a user turn.
+    with _lock_for(sid):
+        history.append({"role": "user", "content": message})
+        if history[0]["role"] == "assistant":
+            history.popleft()
+        return list(history)
+
+
+def _finish_turn(sid: str, history: deque[dict], reply: str) -> int:
+    """Record the assistant reply and return the resulting message count."""
+    with _lock_for(sid):
+        history.append({"role": "assistant", "content": reply})
+        return len(history)
+
+
 @app.post("/session/start")
 def session_start():
     sid, _ = get_or_create_session(None)
-    return jsonify({"session_id": sid})
+    return json_response({"session_id": sid})
 
 
 @app.post("/ask")
 def ask():
     session_id = request.headers.get("X-Session-Id")
-    body = request.get_json(silent=True) or {}
-    message = body.get("message", "").strip()
+    message = _read_message()
     if not message:
-        return jsonify({"error": "missing 'message' field"}), 400
+        return json_response({"error": "missing 'message' field"}, 400)
 
     sid, history = get_or_create_session(session_id)
+    snapshot = _begin_turn(sid, history, message)
 
-    history.append({"role": "user", "content": message})
-
-    # Trim oldest pairs to stay within limit
-    while len(history) > MAX_MESSAGES:
-        history.pop(0)  # user
-        if history and history[0]["role"] == "assistant":
-            history.pop(0)  # assistant
-
+    # The upstream call runs outside the session lock so a slow completion
+    # never blocks other requests hashed to the same stripe.
     try:
-        reply = chat_completion(history)
-    except RuntimeError as exc:
-        return jsonify({"error": str(exc)}), 502
+        reply = chat_completion(snapshot)
+    except (RuntimeError, http.RequestException) as exc:
+        return json_response({"error": str(exc)}, 502)
 
-    history.append({"role": "assistant", "content": reply})
+    message_count = _finish_turn(sid, history, reply)
 
-    return jsonify({
+    return json_response({
         "session_id": sid,
         "reply": reply,
-        "message_count": len(history),
+        "message_count": message_count,
     })
 
 
+@app.post("/ask/stream")
+def ask_stream():
+    session_id = request.headers.get("X-Session-Id")
+    message = _read_message()
+    if not message:
+        return json_response({"error": "missing 'message' field"}, 400)
+
+    sid, history = get_or_create_session(session_id)
+    snapshot = _begin_turn(sid, history, message)
+
+    try:
+        deltas, cache_key = chat_completion_stream(snapshot)
+    except (RuntimeError, http.RequestException) as exc:
+        return json_response({"error": str(exc)}, 502)
+
+    def generate():
+        parts = []
+        try:
+            for piece in deltas:
+                if piece is None:         # reply complete; body is drained below
+                    break
+                parts.append(piece)
+                yield sse_event({"delta": piece})
+        except (RuntimeError, http.RequestException) as exc:
+            yield sse_event({"error": str(exc)}, "error")
+            return
+        try:
+            reply = "".join(parts)
+            if not reply:
+                yield sse_event({"error": EMPTY_REPLY_ERROR}, "error")
+                return
+            _store_reply(cache_key, reply)
+            message_count = _finish_turn(sid, history, reply)
+            yield sse_event({"session_id": sid, "message_count": message_count}, "done")
+        finally:
+            # Only after "done" is sent: the provider may hold the body open.
+            drain_stream(deltas)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"X-Session-Id": sid, "Cache-Control": "no-cache"},
+    )
+
+
 @app.post("/session/reset")
 def session_reset():
     session_id = request.headers.get("X-Session-Id")
-    if not session_id or session_id not in sessions:
-        return jsonify({"error": "invalid or missing session_id"}), 400
-    sessions[session_id].clear()
-    return jsonify({"status": "ok", "session_id": session_id})
+    with _sessions_lock:
+        history = sessions.get(session_id) if session_id else None
+    if history is None:
+        return json_response({"error": "invalid or missing session_id"}, 400)
+    with _lock_for(session_id):
+        history.clear()
+    return json_response({"status": "ok", "session_id": session_id})
 
 
 if __name__ == "__main__":
+    if not os.getenv("FLASK_DEV"):
+        raise SystemExit("Run under gunicorn (see gunicorn.conf.py), or set FLASK_DEV=1 for the dev server")
     app.run(debug=True, port=5000)
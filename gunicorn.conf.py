@@ -0,0 +1,12 @@
+# Production entrypoint: `gunicorn app:app` (this file is picked up from cwd).
+#
+# /ask spends nearly all its time waiting on the LLM provider, so a gevent
+# worker multiplexes many in-flight requests on greenlets. Sessions live in
+# process memory, so a single worker is used: with several, a session id
+# created in one worker would be unknown to the others.
+
+bind = "0.0.0.0:5000"
+workers = 1
+worker_class = "gevent"
+worker_connections = 1000
+keepalive = 65